@@ -0,0 +1,30 @@
+"""Compile the autotrader's quote pricing function ahead of time.
+
+Run "python3 aot_build.py" to build the autotrader_kernels extension module
+from compute_quote in autotrader.py. When that module exists, autotrader.py
+imports it instead of compiling compute_quote with numba at start-up.
+
+The module is not checked against the source, so rerun this script whenever
+compute_quote changes, and delete the module to go back to the just-in-time
+compiled version.
+"""
+import importlib.util
+import pathlib
+import sys
+
+from numba.pycc import CC
+
+# Load autotrader.py by path because, once it has been compiled with setup.py,
+# importing "autotrader" would load the Cython extension instead.
+_spec = importlib.util.spec_from_file_location("autotrader_source",
+                                               pathlib.Path(__file__).with_name("autotrader.py"))
+autotrader = importlib.util.module_from_spec(_spec)
+sys.modules[_spec.name] = autotrader
+_spec.loader.exec_module(autotrader)
+
+cc = CC("autotrader_kernels")
+cc.verbose = True
+cc.export("compute_quote", autotrader.QUOTE_SIGNATURE)(autotrader.compute_quote)
+
+if __name__ == "__main__":
+    cc.compile()
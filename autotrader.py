@@ -1,7 +1,34 @@
 import asyncio
-import itertools
-from typing import List
+import logging
+import pathlib
+from typing import List, Tuple
 from ready_trader_go import BaseAutoTrader, Instrument, Lifespan, MAXIMUM_ASK, MINIMUM_BID, Side
+from ready_trader_go.messages import (CANCEL_MESSAGE, CANCEL_MESSAGE_SIZE, HEADER, INSERT_MESSAGE,
+                                      INSERT_MESSAGE_SIZE, MessageType)
+
+try:
+    import cython
+    COMPILED = cython.compiled
+except ImportError:
+    COMPILED = False
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# numba can only compile plain Python functions, so it is not used when this
+# module has been compiled with Cython by setup.py.
+if njit is None or COMPILED:
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+# The compiled module is imported in place of this file, so warn when this file
+# has been changed since it was compiled.
+if COMPILED:
+    _source = pathlib.Path(__file__).with_name(__name__ + ".py")
+    if _source.exists() and _source.stat().st_mtime > pathlib.Path(__file__).stat().st_mtime:
+        logging.getLogger("TRADER").warning("%s has changed since it was compiled", _source.name)
 
 LOT_SIZE = 20
 POSITION_LIMIT = 100
@@ -10,114 +37,179 @@ MIN_BID_NEAREST_TICK = (
     MINIMUM_BID + TICK_SIZE_IN_CENTS) // TICK_SIZE_IN_CENTS * TICK_SIZE_IN_CENTS
 MAX_ASK_NEAREST_TICK = MAXIMUM_ASK // TICK_SIZE_IN_CENTS * TICK_SIZE_IN_CENTS
 
+# Message headers for the cancel and insert requests sent from the order book
+# callback, which are framed here so that they can be sent in one write.
+CANCEL_HEADER = HEADER.pack(CANCEL_MESSAGE_SIZE, MessageType.CANCEL_ORDER)
+INSERT_HEADER = HEADER.pack(INSERT_MESSAGE_SIZE, MessageType.INSERT_ORDER)
+
+
+QUOTE_SIGNATURE = "UniTuple(i8, 2)(i8, i8, i8, i8, i8, i8, i8)"
+
+
+@njit(inline="always", cache=True)
+def _clamp_tick(price: int, lo: int, hi: int) -> int:
+    """Clamp a price to the range [lo, hi] and round it down to the nearest tick."""
+    if price < lo:
+        price = lo
+    if price > hi:
+        price = hi
+    return price - price % TICK_SIZE_IN_CENTS
+
+
+def compute_quote(bid0: int, ask0: int, bid_volume0: int, ask_volume0: int, bid2: int, ask2: int,
+                  position: int) -> Tuple[int, int]:
+    """Return the bid and ask prices to quote, rounded down to the nearest tick."""
+    if bid_volume0 > 0 and ask_volume0 > 0:
+        mid_price = (bid0 * ask_volume0 + ask0 * bid_volume0) // (bid_volume0 + ask_volume0)
+    else:
+        mid_price = (bid0 + ask0) // 2
+
+    spread = ask2 - bid2
+    hi_bid = MAX_ASK_NEAREST_TICK - spread
+    lo_ask = MIN_BID_NEAREST_TICK + spread
+
+    # Work in 1/200ths of a cent so that the position skew, position * spread / 200,
+    # is exact.
+    fair_price = mid_price * 200 + position * spread
+    if fair_price < MIN_BID_NEAREST_TICK * 200:
+        fair_price = MIN_BID_NEAREST_TICK * 200
+    if fair_price > MAX_ASK_NEAREST_TICK * 200:
+        fair_price = MAX_ASK_NEAREST_TICK * 200
+
+    bid_price = _clamp_tick((fair_price - spread * 100) // 200, MIN_BID_NEAREST_TICK, hi_bid)
+    ask_price = _clamp_tick((fair_price + spread * 100) // 200, lo_ask, MAX_ASK_NEAREST_TICK)
+
+    return bid_price, ask_price
+
+
+# Use the ahead-of-time compiled version of compute_quote built by aot_build.py
+# if there is one, otherwise compile it when this module is imported. The
+# compiled version is not checked against the source, so rerun aot_build.py
+# whenever compute_quote changes.
+try:
+    from autotrader_kernels import compute_quote as _compute_quote
+except ImportError:
+    _compute_quote = njit(QUOTE_SIGNATURE, cache=True)(compute_quote)
+
 
 class AutoTrader(BaseAutoTrader):
     def __init__(self, loop: asyncio.AbstractEventLoop, team_name: str, secret: str):
         super().__init__(loop, team_name, secret)
-        self.order_ids = itertools.count(1)
-        self.bids = {}
-        self.asks = {}
-        self.ask_id = self.ask_price = self.bid_id = self.bid_price = self.position = 0
+        self._next_id = 0
+        # Volume of each live order, positive for bids and negative for asks.
+        self.signed_volumes = {}
+        self.ask_id = self.ask_price = self.bid_id = self.bid_price = self.position = self.position_lots = 0
+        self.outstanding_ask_volume = self.outstanding_bid_volume = 0
+        self._info_enabled = self.logger.isEnabledFor(logging.INFO)
+        self._log_info = self.logger.info
 
     def on_error_message(self, client_order_id: int, error_message: bytes) -> None:
         self.logger.warning("error with order %d: %s",
                             client_order_id, error_message.decode())
-        if client_order_id != 0 and (client_order_id in self.bids or client_order_id in self.asks):
+        if client_order_id != 0 and client_order_id in self.signed_volumes:
             self.on_order_status_message(client_order_id, 0, 0, 0)
 
     def on_hedge_filled_message(self, client_order_id: int, price: int, volume: int) -> None:
-        self.logger.info("received hedge filled for order %d with average price %d and volume %d", client_order_id,
-                         price, volume)
+        if self._info_enabled:
+            self._log_info("received hedge filled for order %d with average price %d and volume %d", client_order_id,
+                           price, volume)
 
     def on_order_filled_message(self, client_order_id: int, price: int, volume: int) -> None:
-        self.logger.info("received order filled for order %d with price %d and volume %d", client_order_id,
-                         price, volume)
+        if self._info_enabled:
+            self._log_info("received order filled for order %d with price %d and volume %d", client_order_id,
+                           price, volume)
 
-        if client_order_id in self.bids:
+        signed_volume = self.signed_volumes.get(client_order_id, 0)
+        if signed_volume > 0:
             self.position += volume
             if self.position > POSITION_LIMIT:
                 self.position = POSITION_LIMIT
             else:
-                self.send_hedge_order(next(self.order_ids),
-                                      Side.ASK, MIN_BID_NEAREST_TICK, volume)
+                self._next_id += 1
+                self.send_hedge_order(self._next_id, Side.ASK, MIN_BID_NEAREST_TICK, volume)
 
-        elif client_order_id in self.asks:
+        elif signed_volume < 0:
             self.position -= volume
             if self.position < -POSITION_LIMIT:
                 self.position = -POSITION_LIMIT
             else:
-                self.send_hedge_order(next(self.order_ids),
-                                      Side.BID, MAX_ASK_NEAREST_TICK, volume)
+                self._next_id += 1
+                self.send_hedge_order(self._next_id, Side.BID, MAX_ASK_NEAREST_TICK, volume)
+
+        self.position_lots = self.position // LOT_SIZE
 
     def on_order_status_message(self, client_order_id: int, fill_volume: int, remaining_volume: int,
                                 fees: int) -> None:
-        self.logger.info("received order status for order %d with fill volume %d remaining %d and fees %d",
-                         client_order_id, fill_volume, remaining_volume, fees)
-        if remaining_volume == 0:
-            if client_order_id == self.bid_id:
-                self.bid_id = 0
-            elif client_order_id == self.ask_id:
-                self.ask_id = 0
-            self.bids.pop(client_order_id, None)
-            self.asks.pop(client_order_id, None)
+        if remaining_volume != 0:
+            return
+
+        if self._info_enabled:
+            self._log_info("received order status for order %d with fill volume %d remaining %d and fees %d",
+                           client_order_id, fill_volume, remaining_volume, fees)
+        if client_order_id == self.bid_id:
+            self.bid_id = 0
+        elif client_order_id == self.ask_id:
+            self.ask_id = 0
+        signed_volume = self.signed_volumes.pop(client_order_id, 0)
+        if signed_volume > 0:
+            self.outstanding_bid_volume -= signed_volume
+        elif signed_volume < 0:
+            self.outstanding_ask_volume += signed_volume
 
     def on_trade_ticks_message(self, instrument: int, sequence_number: int, ask_prices: List[int],
                                ask_volumes: List[int], bid_prices: List[int], bid_volumes: List[int]) -> None:
-        self.logger.info("received trade ticks for instrument %d with sequence number %d", instrument,
-                         sequence_number)
+        if self._info_enabled:
+            self._log_info("received trade ticks for instrument %d with sequence number %d", instrument,
+                           sequence_number)
 
     def on_order_book_update_message(self, instrument: int, sequence_number: int, ask_prices: List[int],
                                      ask_volumes: List[int], bid_prices: List[int], bid_volumes: List[int]) -> None:
-        self.logger.info("received order book for instrument %d with sequence number %d", instrument,
-                         sequence_number)
         if instrument == Instrument.FUTURE:
+            frames = []
+            position_limit = POSITION_LIMIT
+            position = self.position
+            signed_volumes = self.signed_volumes
+
             bid_volume = bid_volumes[0]
             ask_volume = ask_volumes[0]
-            position = self.position // LOT_SIZE
-            mid_price = (bid_prices[0] + ask_prices[0]) // 2
-
-            spread = ask_prices[2] - bid_prices[2]
-
-            fair_price = mid_price + (position / 100) * spread / 2
-
-            fair_price = min(MAX_ASK_NEAREST_TICK, max(
-                MIN_BID_NEAREST_TICK, fair_price))
-
-            bid_price = fair_price - spread / 2
-            ask_price = fair_price + spread / 2
-
-            bid_price = min(MAX_ASK_NEAREST_TICK - spread,
-                            max(MIN_BID_NEAREST_TICK, bid_price)) // TICK_SIZE_IN_CENTS * TICK_SIZE_IN_CENTS
-            ask_price = min(MAX_ASK_NEAREST_TICK, max(
-                MIN_BID_NEAREST_TICK + spread, ask_price)) // TICK_SIZE_IN_CENTS * TICK_SIZE_IN_CENTS
-
-            if self.bid_id != 0 and bid_price not in (self.bid_price, 0):
-                self.send_cancel_order(self.bid_id)
-                self.bid_id = 0
-            if self.ask_id != 0 and ask_price not in (self.ask_price, 0):
-                self.send_cancel_order(self.ask_id)
-                self.ask_id = 0
-
-            if self.bid_id == 0 and self.position < POSITION_LIMIT:
-                outstanding_bid_volume = sum(
-                    order['size'] for order in self.bids.values())
-                max_order_size = min(14, max(
-                    0, min(POSITION_LIMIT - self.position - outstanding_bid_volume, bid_volume)))
-                self.bid_id = next(self.order_ids)
-                self.bid_price = bid_price
-                self.send_insert_order(self.bid_id, Side.BUY, int(
-                    bid_price), max_order_size, Lifespan.GFD)
-                self.bids[self.bid_id] = {
-                    'price': bid_price, 'size': max_order_size}
-
-            if self.ask_id == 0 and self.position > -POSITION_LIMIT:
-                outstanding_ask_volume = sum(
-                    order['size'] for order in self.asks.values())
-                max_order_size = min(14, max(
-                    0, min(POSITION_LIMIT + self.position - outstanding_ask_volume, ask_volume)))
-                self.ask_id = next(self.order_ids)
-                self.ask_price = ask_price
-                self.send_insert_order(self.ask_id, Side.SELL, int(
-                    ask_price), max_order_size, Lifespan.GFD)
-                self.asks[self.ask_id] = {
-                    'price': ask_price, 'size': max_order_size}
+            bid_price, ask_price = _compute_quote(bid_prices[0], ask_prices[0], bid_volume, ask_volume,
+                                                  bid_prices[2], ask_prices[2], self.position_lots)
+
+            # Order state is only updated once its frame has been packed, so send the
+            # frames built so far even if a later one fails to pack.
+            try:
+                if self.bid_id != 0 and bid_price != self.bid_price and bid_price >= MIN_BID_NEAREST_TICK:
+                    frames.append(CANCEL_HEADER + CANCEL_MESSAGE.pack(self.bid_id))
+                    self.bid_id = 0
+                if self.ask_id != 0 and ask_price != self.ask_price and ask_price >= MIN_BID_NEAREST_TICK:
+                    frames.append(CANCEL_HEADER + CANCEL_MESSAGE.pack(self.ask_id))
+                    self.ask_id = 0
+
+                if self.bid_id == 0 and bid_price >= MIN_BID_NEAREST_TICK and position < position_limit:
+                    max_order_size = min(14, max(
+                        0, min(position_limit - position - self.outstanding_bid_volume, bid_volume)))
+                    bid_id = self._next_id + 1
+                    frames.append(INSERT_HEADER + INSERT_MESSAGE.pack(bid_id, Side.BUY, bid_price, max_order_size,
+                                                                      Lifespan.GFD))
+                    self._next_id = self.bid_id = bid_id
+                    self.bid_price = bid_price
+                    signed_volumes[bid_id] = max_order_size
+                    self.outstanding_bid_volume += max_order_size
+
+                if self.ask_id == 0 and ask_price >= MIN_BID_NEAREST_TICK and position > -position_limit:
+                    max_order_size = min(14, max(
+                        0, min(position_limit + position - self.outstanding_ask_volume, ask_volume)))
+                    ask_id = self._next_id + 1
+                    frames.append(INSERT_HEADER + INSERT_MESSAGE.pack(ask_id, Side.SELL, ask_price, max_order_size,
+                                                                      Lifespan.GFD))
+                    self._next_id = self.ask_id = ask_id
+                    self.ask_price = ask_price
+                    signed_volumes[ask_id] = -max_order_size
+                    self.outstanding_ask_volume += max_order_size
+            finally:
+                if frames:
+                    self._send_frames(frames)
+
+    def _send_frames(self, frames: List[bytes]) -> None:
+        """Send several framed execution messages with a single write."""
+        self._connection_transport.write(b"".join(frames))
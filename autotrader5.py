@@ -1,7 +1,18 @@
 import asyncio
-import itertools
-from typing import List
+import logging
+from typing import List, Tuple
+
+import numpy as np
+
 from ready_trader_go import BaseAutoTrader, Instrument, Lifespan, MAXIMUM_ASK, MINIMUM_BID, Side
+from ready_trader_go.messages import (CANCEL_MESSAGE, CANCEL_MESSAGE_SIZE, HEADER, INSERT_MESSAGE,
+                                      INSERT_MESSAGE_SIZE, MessageType)
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 LOT_SIZE = 20
 POSITION_LIMIT = 100
@@ -10,114 +21,219 @@ MIN_BID_NEAREST_TICK = (
     MINIMUM_BID + TICK_SIZE_IN_CENTS) // TICK_SIZE_IN_CENTS * TICK_SIZE_IN_CENTS
 MAX_ASK_NEAREST_TICK = MAXIMUM_ASK // TICK_SIZE_IN_CENTS * TICK_SIZE_IN_CENTS
 
+# Message headers for the cancel and insert requests sent from the order book
+# callback, which are framed here so that they can be sent in one write.
+CANCEL_HEADER = HEADER.pack(CANCEL_MESSAGE_SIZE, MessageType.CANCEL_ORDER)
+INSERT_HEADER = HEADER.pack(INSERT_MESSAGE_SIZE, MessageType.INSERT_ORDER)
+
+# Order ids are sequential, so the id modulo the number of slots indexes a
+# ring of per-order state. Ids wrap around the ring during a match and a GFD
+# order can stay live for any number of ids, so quote ids whose slot still
+# holds a live order are skipped rather than reused. Hedge ids are not, so each
+# slot also records the id of its order and only that id is treated as live.
+ORDER_SLOTS = 4096
+ORDER_SLOT_MASK = ORDER_SLOTS - 1
+
+
+QUOTE_SIGNATURE = "UniTuple(i8, 2)(i8, i8, i8, i8, i8, i8, i8)"
+
+
+@njit(inline="always", cache=True)
+def _clamp_tick(price: int, lo: int, hi: int) -> int:
+    """Clamp a price to the range [lo, hi] and round it down to the nearest tick."""
+    if price < lo:
+        price = lo
+    if price > hi:
+        price = hi
+    return price - price % TICK_SIZE_IN_CENTS
+
+
+def compute_quote(bid0: int, ask0: int, bid_volume0: int, ask_volume0: int, bid2: int, ask2: int,
+                  position: int) -> Tuple[int, int]:
+    """Return the bid and ask prices to quote, rounded down to the nearest tick."""
+    if bid_volume0 > 0 and ask_volume0 > 0:
+        mid_price = (bid0 * ask_volume0 + ask0 * bid_volume0) // (bid_volume0 + ask_volume0)
+    else:
+        mid_price = (bid0 + ask0) // 2
+
+    spread = ask2 - bid2
+    hi_bid = MAX_ASK_NEAREST_TICK - spread
+    lo_ask = MIN_BID_NEAREST_TICK + spread
+
+    # Work in 1/200ths of a cent so that the position skew, position * spread / 200,
+    # is exact.
+    fair_price = mid_price * 200 + position * spread
+    if fair_price < MIN_BID_NEAREST_TICK * 200:
+        fair_price = MIN_BID_NEAREST_TICK * 200
+    if fair_price > MAX_ASK_NEAREST_TICK * 200:
+        fair_price = MAX_ASK_NEAREST_TICK * 200
+
+    bid_price = _clamp_tick((fair_price - spread * 100) // 200, MIN_BID_NEAREST_TICK, hi_bid)
+    ask_price = _clamp_tick((fair_price + spread * 100) // 200, lo_ask, MAX_ASK_NEAREST_TICK)
+
+    return bid_price, ask_price
+
+
+_compute_quote = njit(QUOTE_SIGNATURE, cache=True)(compute_quote)
+
 
 class AutoTrader(BaseAutoTrader):
     def __init__(self, loop: asyncio.AbstractEventLoop, team_name: str, secret: str):
         super().__init__(loop, team_name, secret)
-        self.order_ids = itertools.count(1)
-        self.bids = {}
-        self.asks = {}
-        self.ask_id = self.ask_price = self.bid_id = self.bid_price = self.position = 0
+        self._next_id = 0
+        self.order_id = np.zeros(ORDER_SLOTS, dtype=np.int64)
+        self.order_price = np.zeros(ORDER_SLOTS, dtype=np.int64)
+        self.order_size = np.zeros(ORDER_SLOTS, dtype=np.int16)
+        self.live_bid = np.zeros(ORDER_SLOTS, dtype=bool)
+        self.live_ask = np.zeros(ORDER_SLOTS, dtype=bool)
+        self.ask_id = self.ask_price = self.bid_id = self.bid_price = self.position = self.position_lots = 0
+        self.outstanding_ask_volume = self.outstanding_bid_volume = 0
+        self._info_enabled = self.logger.isEnabledFor(logging.INFO)
+        self._log_info = self.logger.info
 
     def on_error_message(self, client_order_id: int, error_message: bytes) -> None:
         self.logger.warning("error with order %d: %s",
                             client_order_id, error_message.decode())
-        if client_order_id != 0 and (client_order_id in self.bids or client_order_id in self.asks):
+        slot = client_order_id & ORDER_SLOT_MASK
+        if client_order_id != 0 and self.order_id[slot] == client_order_id:
             self.on_order_status_message(client_order_id, 0, 0, 0)
+        self._check_outstanding_volume()
 
     def on_hedge_filled_message(self, client_order_id: int, price: int, volume: int) -> None:
-        self.logger.info("received hedge filled for order %d with average price %d and volume %d", client_order_id,
-                         price, volume)
+        if self._info_enabled:
+            self._log_info("received hedge filled for order %d with average price %d and volume %d", client_order_id,
+                           price, volume)
 
     def on_order_filled_message(self, client_order_id: int, price: int, volume: int) -> None:
-        self.logger.info("received order filled for order %d with price %d and volume %d", client_order_id,
-                         price, volume)
+        if self._info_enabled:
+            self._log_info("received order filled for order %d with price %d and volume %d", client_order_id,
+                           price, volume)
+
+        slot = client_order_id & ORDER_SLOT_MASK
+        if self.order_id[slot] != client_order_id:
+            return
 
-        if client_order_id in self.bids:
+        if self.live_bid[slot]:
             self.position += volume
             if self.position > POSITION_LIMIT:
                 self.position = POSITION_LIMIT
             else:
-                self.send_hedge_order(next(self.order_ids),
-                                      Side.ASK, MIN_BID_NEAREST_TICK, volume)
+                self._next_id += 1
+                self.send_hedge_order(self._next_id, Side.ASK, MIN_BID_NEAREST_TICK, volume)
 
-        elif client_order_id in self.asks:
+        elif self.live_ask[slot]:
             self.position -= volume
             if self.position < -POSITION_LIMIT:
                 self.position = -POSITION_LIMIT
             else:
-                self.send_hedge_order(next(self.order_ids),
-                                      Side.BID, MAX_ASK_NEAREST_TICK, volume)
+                self._next_id += 1
+                self.send_hedge_order(self._next_id, Side.BID, MAX_ASK_NEAREST_TICK, volume)
+
+        self.position_lots = self.position // LOT_SIZE
 
     def on_order_status_message(self, client_order_id: int, fill_volume: int, remaining_volume: int,
                                 fees: int) -> None:
-        self.logger.info("received order status for order %d with fill volume %d remaining %d and fees %d",
-                         client_order_id, fill_volume, remaining_volume, fees)
-        if remaining_volume == 0:
-            if client_order_id == self.bid_id:
-                self.bid_id = 0
-            elif client_order_id == self.ask_id:
-                self.ask_id = 0
-            self.bids.pop(client_order_id, None)
-            self.asks.pop(client_order_id, None)
+        if remaining_volume != 0:
+            return
+
+        if self._info_enabled:
+            self._log_info("received order status for order %d with fill volume %d remaining %d and fees %d",
+                           client_order_id, fill_volume, remaining_volume, fees)
+        if client_order_id == self.bid_id:
+            self.bid_id = 0
+        elif client_order_id == self.ask_id:
+            self.ask_id = 0
+        slot = client_order_id & ORDER_SLOT_MASK
+        if self.order_id[slot] != client_order_id:
+            return
+        if self.live_bid[slot]:
+            self.outstanding_bid_volume -= int(self.order_size[slot])
+            self.live_bid[slot] = False
+        elif self.live_ask[slot]:
+            self.outstanding_ask_volume -= int(self.order_size[slot])
+            self.live_ask[slot] = False
+        self.order_id[slot] = self.order_price[slot] = self.order_size[slot] = 0
 
     def on_trade_ticks_message(self, instrument: int, sequence_number: int, ask_prices: List[int],
                                ask_volumes: List[int], bid_prices: List[int], bid_volumes: List[int]) -> None:
-        self.logger.info("received trade ticks for instrument %d with sequence number %d", instrument,
-                         sequence_number)
+        if self._info_enabled:
+            self._log_info("received trade ticks for instrument %d with sequence number %d", instrument,
+                           sequence_number)
 
     def on_order_book_update_message(self, instrument: int, sequence_number: int, ask_prices: List[int],
                                      ask_volumes: List[int], bid_prices: List[int], bid_volumes: List[int]) -> None:
-        self.logger.info("received order book for instrument %d with sequence number %d", instrument,
-                         sequence_number)
         if instrument == Instrument.FUTURE:
+            frames = []
+            position_limit = POSITION_LIMIT
+            position = self.position
+            order_id = self.order_id
+            order_price = self.order_price
+            order_size = self.order_size
+            live_bid = self.live_bid
+            live_ask = self.live_ask
+
             bid_volume = bid_volumes[0]
             ask_volume = ask_volumes[0]
-            position = self.position // LOT_SIZE
-            mid_price = (bid_prices[0] + ask_prices[0]) // 2
-
-            spread = ask_prices[2] - bid_prices[2]
-
-            fair_price = mid_price + (position / 100) * spread / 2
-
-            fair_price = min(MAX_ASK_NEAREST_TICK, max(
-                MIN_BID_NEAREST_TICK, fair_price))
-
-            bid_price = fair_price - spread / 2
-            ask_price = fair_price + spread / 2
-
-            bid_price = min(MAX_ASK_NEAREST_TICK - spread,
-                            max(MIN_BID_NEAREST_TICK, bid_price)) // TICK_SIZE_IN_CENTS * TICK_SIZE_IN_CENTS
-            ask_price = min(MAX_ASK_NEAREST_TICK, max(
-                MIN_BID_NEAREST_TICK + spread, ask_price)) // TICK_SIZE_IN_CENTS * TICK_SIZE_IN_CENTS
-
-            if self.bid_id != 0 and bid_price not in (self.bid_price, 0):
-                self.send_cancel_order(self.bid_id)
-                self.bid_id = 0
-            if self.ask_id != 0 and ask_price not in (self.ask_price, 0):
-                self.send_cancel_order(self.ask_id)
-                self.ask_id = 0
-
-            if self.bid_id == 0 and self.position < POSITION_LIMIT:
-                outstanding_bid_volume = sum(
-                    order['size'] for order in self.bids.values())
-                max_order_size = min(14, max(
-                    0, min(POSITION_LIMIT - self.position - outstanding_bid_volume, bid_volume)))
-                self.bid_id = next(self.order_ids)
-                self.bid_price = bid_price
-                self.send_insert_order(self.bid_id, Side.BUY, int(
-                    bid_price), max_order_size, Lifespan.GFD)
-                self.bids[self.bid_id] = {
-                    'price': bid_price, 'size': max_order_size}
-
-            if self.ask_id == 0 and self.position > -POSITION_LIMIT:
-                outstanding_ask_volume = sum(
-                    order['size'] for order in self.asks.values())
-                max_order_size = min(14, max(
-                    0, min(POSITION_LIMIT + self.position - outstanding_ask_volume, ask_volume)))
-                self.ask_id = next(self.order_ids)
-                self.ask_price = ask_price
-                self.send_insert_order(self.ask_id, Side.SELL, int(
-                    ask_price), max_order_size, Lifespan.GFD)
-                self.asks[self.ask_id] = {
-                    'price': ask_price, 'size': max_order_size}
+            bid_price, ask_price = _compute_quote(bid_prices[0], ask_prices[0], bid_volume, ask_volume,
+                                                  bid_prices[2], ask_prices[2], self.position_lots)
+
+            # Order state is only updated once its frame has been packed, so send the
+            # frames built so far even if a later one fails to pack.
+            try:
+                if self.bid_id != 0 and bid_price != self.bid_price and bid_price >= MIN_BID_NEAREST_TICK:
+                    frames.append(CANCEL_HEADER + CANCEL_MESSAGE.pack(self.bid_id))
+                    self.bid_id = 0
+                if self.ask_id != 0 and ask_price != self.ask_price and ask_price >= MIN_BID_NEAREST_TICK:
+                    frames.append(CANCEL_HEADER + CANCEL_MESSAGE.pack(self.ask_id))
+                    self.ask_id = 0
+
+                if self.bid_id == 0 and bid_price >= MIN_BID_NEAREST_TICK and position < position_limit:
+                    max_order_size = min(14, max(
+                        0, min(position_limit - position - self.outstanding_bid_volume, bid_volume)))
+                    bid_id = self._next_id + 1
+                    while live_bid[bid_id & ORDER_SLOT_MASK] or live_ask[bid_id & ORDER_SLOT_MASK]:
+                        bid_id += 1
+                    frames.append(INSERT_HEADER + INSERT_MESSAGE.pack(bid_id, Side.BUY, bid_price, max_order_size,
+                                                                      Lifespan.GFD))
+                    self._next_id = self.bid_id = bid_id
+                    self.bid_price = bid_price
+                    slot = bid_id & ORDER_SLOT_MASK
+                    order_id[slot] = bid_id
+                    order_price[slot] = bid_price
+                    order_size[slot] = max_order_size
+                    live_bid[slot] = True
+                    self.outstanding_bid_volume += max_order_size
+
+                if self.ask_id == 0 and ask_price >= MIN_BID_NEAREST_TICK and position > -position_limit:
+                    max_order_size = min(14, max(
+                        0, min(position_limit + position - self.outstanding_ask_volume, ask_volume)))
+                    ask_id = self._next_id + 1
+                    while live_bid[ask_id & ORDER_SLOT_MASK] or live_ask[ask_id & ORDER_SLOT_MASK]:
+                        ask_id += 1
+                    frames.append(INSERT_HEADER + INSERT_MESSAGE.pack(ask_id, Side.SELL, ask_price, max_order_size,
+                                                                      Lifespan.GFD))
+                    self._next_id = self.ask_id = ask_id
+                    self.ask_price = ask_price
+                    slot = ask_id & ORDER_SLOT_MASK
+                    order_id[slot] = ask_id
+                    order_price[slot] = ask_price
+                    order_size[slot] = max_order_size
+                    live_ask[slot] = True
+                    self.outstanding_ask_volume += max_order_size
+            finally:
+                if frames:
+                    self._send_frames(frames)
+
+    def _send_frames(self, frames: List[bytes]) -> None:
+        """Send several framed execution messages with a single write."""
+        self._connection_transport.write(b"".join(frames))
+
+    def _check_outstanding_volume(self) -> None:
+        """Check the outstanding bid and ask volumes against the order slots."""
+        bid_volume = int(np.add.reduce(self.order_size, where=self.live_bid))
+        ask_volume = int(np.add.reduce(self.order_size, where=self.live_ask))
+        if bid_volume != self.outstanding_bid_volume or ask_volume != self.outstanding_ask_volume:
+            self.logger.warning("outstanding volume is bid %d ask %d but the live orders total bid %d ask %d",
+                                self.outstanding_bid_volume, self.outstanding_ask_volume, bid_volume, ask_volume)
+            self.outstanding_bid_volume = bid_volume
+            self.outstanding_ask_volume = ask_volume
@@ -0,0 +1,14 @@
+"""Compile the example autotrader with Cython.
+
+Run "python3 setup.py build_ext --inplace" to compile autotrader.py. The
+compiled module takes precedence over autotrader.py when an autotrader
+named "autotrader" is run, so run this again after changing autotrader.py,
+or delete the compiled module to go back to the Python version.
+"""
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+    name="autotrader",
+    ext_modules=cythonize(["autotrader.py"], language_level=3),
+)